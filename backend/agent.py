@@ -1,22 +1,30 @@
 
 from pydantic_ai import Agent, RunContext
 from pydantic import BaseModel, Field
-from typing import List, Dict, Optional, Any, Literal
+from typing import List, Dict, Optional, Any, Literal, AsyncIterator
 import os
 from dotenv import load_dotenv
 from pinecone import Pinecone
-from sentence_transformers import SentenceTransformer
+import torch
+from embedding import API_WORKERS, load_embedder
+from catalog_utils import extract_dependency_specs
 from pydantic_ai.models.openai import OpenAIModel
 
 from pydantic_ai.models.anthropic import AnthropicModel
 
-import json
+import orjson
+import re
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from pathlib import Path
+import asyncio
+import hashlib
+from cachetools import LRUCache, TTLCache
 
 load_dotenv()
 
-# Embedding model
-embedder = SentenceTransformer('all-MiniLM-L6-v2')
+# Embedding model (module partagé avec ingest_catalog.py)
+embedder = load_embedder()
 
 # Pinecone
 pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
@@ -224,55 +232,88 @@ Si un service de est validé, ne propose pas un autre service similaire.
 # FONCTIONS UTILITAIRES
 # ============================================================================
 
-def load_service_full_json(service_id: str) -> Optional[Dict]:
-    """Charge JSON complet service."""
-    for json_file in CATALOG_DIR.glob("*.json"):
+def extract_dependencies(service_json: Dict) -> List[ServiceDependency]:
+    """Extrait dépendances CFSS uniquement."""
+    return [ServiceDependency(**dep) for dep in extract_dependency_specs(service_json)]
+
+def _load_catalog_dependencies() -> tuple:
+    """
+    Dépendances CFSS précalculées (catalogue statique), par id et par nom.
+    Repli pour les index Pinecone sans dépendances dans les métadonnées.
+    """
+    by_id: Dict[str, tuple] = {}
+    by_name: Dict[str, tuple] = {}
+    for json_file in sorted(CATALOG_DIR.glob("*.json")):
         try:
-            with open(json_file, 'r', encoding='utf-8') as f:
-                service = json.load(f)
-                if service.get('id') == service_id or service.get('name') == service_id:
-                    return service
+            service = orjson.loads(json_file.read_bytes())
         except:
             continue
-    return None
+        dependencies = tuple(extract_dependencies(service))
+        # Premier fichier trouvé prioritaire (comme l'ancien parcours séquentiel)
+        if service.get('id') is not None:
+            by_id.setdefault(service['id'], dependencies)
+        if service.get('name') is not None:
+            by_name.setdefault(service['name'], dependencies)
+    return by_id, by_name
+
+_DEPS_BY_ID, _DEPS_BY_NAME = _load_catalog_dependencies()
+
+def get_service_dependencies(service_id: str) -> tuple:
+    """Dépendances CFSS précalculées d'un service (par id ou nom)."""
+    if service_id in _DEPS_BY_ID:
+        return _DEPS_BY_ID[service_id]
+    return _DEPS_BY_NAME.get(service_id, ())
+
+# Cache LRU des embeddings de requêtes (clé = requête normalisée)
+EMBEDDING_CACHE_SIZE = 4096
+_embedding_cache: LRUCache = LRUCache(maxsize=EMBEDDING_CACHE_SIZE)
+
+def _encode_batch(texts: List[str]):
+    """Passe avant du modèle (exécutée hors boucle d'événements)."""
+    # inference_mode est local au thread : activé dans le thread d'encodage
+    with torch.inference_mode():
+        return embedder.encode(
+            texts,
+            batch_size=32,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
 
-def extract_dependencies(service_json: Dict) -> List[ServiceDependency]:
-    """Extrait dépendances CFSS uniquement."""
-    dependencies = []
+async def encode_queries(queries: List[str]) -> List[List[float]]:
+    """Encode un lot de requêtes en un seul appel, avec cache LRU."""
+    keys = [q.strip().lower() for q in queries]
+    unique_keys = list(dict.fromkeys(keys))
     
-    for rel in service_json.get('serviceSpecRelationship', []):
-        if rel.get('relationshipType') == 'dependsOn':
-            spec = rel.get('serviceSpec', {})
-            
-            if spec.get('@referredType') == 'CustomerFacingServiceSpecification':
-                dependencies.append(ServiceDependency(
-                    name=spec.get('name', 'Unknown'),
-                    id=spec.get('id', 'unknown'),
-                    version=spec.get('version', '1.0.0'),
-                    href=spec.get('href', '')
-                ))
-    
-    return dependencies
-
-def search_services_pinecone(query: str, top_k: int = 3, min_score: float = 0.5) -> List[ServiceCandidate]:
-    """Recherche sémantique avec FILTRAGE par score minimum."""
-    embedding = embedder.encode(query).tolist()
-    results = index.query(
-        vector=embedding,
-        top_k=top_k * 2,
-        include_metadata=True
-    )
+    # Lectures/écritures du cache sur la boucle uniquement : pas de verrou
+    vectors_by_key = {k: _embedding_cache[k] for k in unique_keys if k in _embedding_cache}
+    missing = [k for k in unique_keys if k not in vectors_by_key]
+    
+    if missing:
+        vectors = await asyncio.to_thread(_encode_batch, missing)
+        for key, vector in zip(missing, vectors):
+            vectors_by_key[key] = _embedding_cache[key] = tuple(vector.tolist())
     
+    return [list(vectors_by_key[key]) for key in keys]
+
+def build_candidates(matches, min_score: float) -> List[ServiceCandidate]:
+    """Construit les candidats à partir des résultats Pinecone (filtrage score)."""
     candidates = []
-    for match in results.matches:
+    for match in matches:
+        # Scores triés par ordre décroissant : inutile de poursuivre
         if match.score < min_score:
-            continue
+            break
         
         meta = match.metadata
         service_id = meta.get("service_id", "unknown")
         
-        service_full = load_service_full_json(service_id)
-        dependencies = extract_dependencies(service_full) if service_full else []
+        # Dépendances stockées dans les métadonnées Pinecone (index récents),
+        # sinon index mémoire du catalogue
+        deps_json = meta.get("dependencies")
+        if deps_json is not None:
+            dependencies = [ServiceDependency(**d) for d in orjson.loads(deps_json)]
+        else:
+            dependencies = list(get_service_dependencies(service_id))
         
         candidates.append(ServiceCandidate(
             service_id=service_id,
@@ -282,26 +323,35 @@ def search_services_pinecone(query: str, top_k: int = 3, min_score: float = 0.5)
             dependencies=dependencies
         ))
     
-    return candidates[:top_k]
+    return candidates
+
+async def query_pinecone(embedding: List[float], top_k: int = 3):
+    """Requête Pinecone exécutée hors de la boucle d'événements."""
+    return await asyncio.to_thread(
+        index.query,
+        vector=embedding,
+        top_k=top_k,
+        include_metadata=True
+    )
 
 # ============================================================================
 # WORKFLOW - ÉTAT GLOBAL 
 # ============================================================================
 
+@dataclass(slots=True)
 class ConversationState:
     """État conversation avec historique complet."""
-    def __init__(self):
-        self.iteration = 0
-        self.max_iterations = 5
-        
-        # Stocker TOUS les services identifiés
-        self.all_services_identified: Dict[str, ServiceIdentified] = {}
-        # Clé = nom du service, Valeur = ServiceIdentified avec propriétés
-        
-        self.candidats_par_service: Dict[str, List[ServiceCandidate]] = {}
-        self.services_valides: Dict[str, ServiceCandidate] = {}
-        self.historique: List[str] = []
-        self.user_request_original: str = ""
+    iteration: int = 0
+    max_iterations: int = 5
+    
+    # Stocker TOUS les services identifiés
+    all_services_identified: Dict[str, ServiceIdentified] = field(default_factory=dict)
+    # Clé = nom du service, Valeur = ServiceIdentified avec propriétés
+    
+    candidats_par_service: Dict[str, List[ServiceCandidate]] = field(default_factory=dict)
+    services_valides: Dict[str, ServiceCandidate] = field(default_factory=dict)
+    historique: List[str] = field(default_factory=list)
+    user_request_original: str = ""
     
     def add_to_history(self, message: str):
         self.historique.append(message)
@@ -337,58 +387,200 @@ class ConversationState:
 # FONCTIONS WORKFLOW
 # ============================================================================
 
-async def classify_and_route(user_request: str) -> Dict[str, Any]:
-    """Étape 0 : Classification de la demande."""
-    result = await classification_agent.run(user_request)
+# Décompositions lancées de façon spéculative pendant la classification
+# (clé = demande normalisée), récupérées ensuite par decompose_request
+MAX_PENDING_DECOMPOSITIONS = 128
+_pending_decompositions: "OrderedDict[str, asyncio.Task]" = OrderedDict()
+
+def _request_key(user_request: str) -> str:
+    return user_request.strip().lower()
+
+def _retrieve_task_exception(task: asyncio.Task):
+    """Marque l'exception comme lue (tâches annulées/évincées jamais attendues)."""
+    if not task.cancelled():
+        task.exception()
+
+def _store_pending_decomposition(user_request: str, task: asyncio.Task):
+    """Conserve la décomposition spéculative pour /api/decompose."""
+    key = _request_key(user_request)
+    previous = _pending_decompositions.pop(key, None)
+    if previous is not None and previous is not task:
+        previous.cancel()
+    _pending_decompositions[key] = task
+    while len(_pending_decompositions) > MAX_PENDING_DECOMPOSITIONS:
+        _, oldest = _pending_decompositions.popitem(last=False)
+        oldest.cancel()
+
+# Salutations évidentes : pas besoin d'appeler le classifieur LLM
+_GREETING_RE = re.compile(
+    r"^\s*(bonjour|salut|hello|hi|coucou|bonsoir|hey|merci|au revoir)[\s!,.?]*$",
+    re.I
+)
+
+async def _classify(user_request: str) -> str:
+    """Classification LLM, avec décomposition spéculative en parallèle."""
+    # Décomposition lancée en parallèle : gain d'un aller-retour LLM si TELECOM
+    # (inutile si la décomposition est déjà en cache ; désactivée avec plusieurs
+    # workers : /api/decompose arriverait le plus souvent sur un autre processus)
+    if API_WORKERS > 1 or get_cached_decomposition(user_request) is not None:
+        result = await classification_agent.run(user_request)
+        return result.data.strip().upper()
+    
+    decomposition_task = asyncio.create_task(_run_decomposition(user_request))
+    decomposition_task.add_done_callback(_retrieve_task_exception)
+    try:
+        result = await classification_agent.run(user_request)
+    except BaseException:
+        decomposition_task.cancel()
+        raise
     classification = result.data.strip().upper()
     
+    if classification in ("GREETING", "OUT_OF_SCOPE"):
+        decomposition_task.cancel()
+    else:
+        _store_pending_decomposition(user_request, decomposition_task)
+    return classification
+
+TELECOM_MESSAGE = "Demande télécom identifiée. Analyse en cours..."
+
+def _polite_prompt(classification: str, user_request: str) -> Optional[str]:
+    """Prompt de l'agent de politesse (None si demande TELECOM)."""
     if classification == "GREETING":
-        response = await polite_response_agent.run(
-            f"Réponds à cette salutation : '{user_request}'. Propose ton aide pour services télécom 5G/cloud."
-        )
-        return {
-            "type": "GREETING",
-            "message": response.data
-        }
+        return f"Réponds à cette salutation : '{user_request}'. Propose ton aide pour services télécom 5G/cloud."
+    if classification == "OUT_OF_SCOPE":
+        return f"Explique poliment que tu ne peux pas aider avec : '{user_request}'. Rappelle ton expertise (télécom/5G/cloud)."
+    return None
+
+async def _classify_fast(user_request: str) -> str:
+    if _GREETING_RE.match(user_request):
+        return "GREETING"
+    return await _classify(user_request)
+
+# Cache TTL des classifications (clé = demande normalisée)
+CLASSIFICATION_CACHE_TTL = 3600
+CLASSIFICATION_CACHE_SIZE = 4096
+_classification_cache: TTLCache = TTLCache(maxsize=CLASSIFICATION_CACHE_SIZE, ttl=CLASSIFICATION_CACHE_TTL)
+
+async def classify_and_route(user_request: str) -> Dict[str, Any]:
+    """Étape 0 : Classification de la demande (avec cache TTL)."""
+    key = _request_key(user_request)
+    cached = _classification_cache.get(key)
+    if cached is not None:
+        return dict(cached)
     
-    elif classification == "OUT_OF_SCOPE":
-        response = await polite_response_agent.run(
-            f"Explique poliment que tu ne peux pas aider avec : '{user_request}'. Rappelle ton expertise (télécom/5G/cloud)."
-        )
-        return {
-            "type": "OUT_OF_SCOPE",
-            "message": response.data
-        }
+    classification = await _classify_fast(user_request)
+    prompt = _polite_prompt(classification, user_request)
     
-    else:
-        return {
+    if prompt is None:
+        result = {
             "type": "TELECOM",
-            "message": "Demande télécom identifiée. Analyse en cours..."
+            "message": TELECOM_MESSAGE
         }
+    else:
+        response = await polite_response_agent.run(prompt)
+        result = {
+            "type": classification,
+            "message": response.data
+        }
+    
+    _classification_cache[key] = result
+    return dict(result)
 
-async def decompose_request(user_request: str) -> Decomposition:
-    """Phase 1 : Décomposition."""
+async def classify_and_route_stream(user_request: str) -> AsyncIterator[Dict[str, str]]:
+    """Étape 0 en streaming : type d'abord, puis message token par token."""
+    key = _request_key(user_request)
+    cached = _classification_cache.get(key)
+    if cached is not None:
+        yield dict(cached)
+        return
+    
+    classification = await _classify_fast(user_request)
+    prompt = _polite_prompt(classification, user_request)
+    
+    if prompt is None:
+        _classification_cache[key] = {"type": "TELECOM", "message": TELECOM_MESSAGE}
+        yield {"type": "TELECOM", "message": TELECOM_MESSAGE}
+        return
+    
+    yield {"type": classification, "message": ""}
+    deltas = []
+    async with polite_response_agent.run_stream(prompt) as result:
+        async for delta in result.stream_text(delta=True):
+            deltas.append(delta)
+            yield {"type": classification, "message": delta}
+    
+    # Mis en cache seulement si le flux est allé jusqu'au bout
+    _classification_cache[key] = {"type": classification, "message": "".join(deltas)}
+
+async def _run_decomposition(user_request: str) -> Decomposition:
     result = await decomposition_agent.run(user_request)
     return result.data
 
+async def decompose_request(user_request: str) -> Decomposition:
+    """Phase 1 : Décomposition (réutilise la décomposition spéculative si présente)."""
+    pending = _pending_decompositions.pop(_request_key(user_request), None)
+    if pending is not None and not pending.cancelled():
+        try:
+            return await pending
+        except Exception:
+            pass  # Échec spéculatif → nouvel appel
+    return await _run_decomposition(user_request)
+
 async def search_candidates_for_services(decomposition: Decomposition) -> Dict[str, List[ServiceCandidate]]:
     """Phase 2 : Recherche candidats avec filtrage score."""
     candidats_par_service = {}
+    services = decomposition.services_identifies
+    if not services:
+        return candidats_par_service
+    
+    # Un seul passage d'encodage pour toutes les requêtes
+    queries = [f"{s.nom} {s.raison}" for s in services]
+    embeddings = await encode_queries(queries)
+    
+    # Requêtes Pinecone indépendantes → lancées en parallèle
+    results = await asyncio.gather(*[
+        query_pinecone(embedding, top_k=3) for embedding in embeddings
+    ])
     
-    for service_id in decomposition.services_identifies:
-        query = f"{service_id.nom} {service_id.raison}"
-        candidates = search_services_pinecone(query, top_k=3, min_score=0.2)
-        candidats_par_service[service_id.nom] = candidates
+    for service, result in zip(services, results):
+        candidats_par_service[service.nom] = build_candidates(result.matches, min_score=0.2)
     
     return candidats_par_service
 
-async def reformulate_request(
-    services_refuses: List[str], 
+# Cache TTL des phases 1 + 2 (clé = sha1 de la demande normalisée)
+DECOMPOSITION_CACHE_TTL = 6 * 3600
+DECOMPOSITION_CACHE_SIZE = 1024
+_decomposition_cache: TTLCache = TTLCache(maxsize=DECOMPOSITION_CACHE_SIZE, ttl=DECOMPOSITION_CACHE_TTL)
+
+def _decomposition_cache_key(user_request: str) -> str:
+    return hashlib.sha1(_request_key(user_request).encode("utf-8")).hexdigest()
+
+def get_cached_decomposition(user_request: str) -> Optional[tuple]:
+    """Retourne (decomposition, candidats) en cache, ou None si absent/expiré."""
+    return _decomposition_cache.get(_decomposition_cache_key(user_request))
+
+async def decompose_and_search(user_request: str) -> tuple:
+    """Phases 1 + 2 : décomposition puis recherche des candidats, avec cache TTL."""
+    cached = get_cached_decomposition(user_request)
+    if cached is not None:
+        return cached
+    
+    decomposition = await decompose_request(user_request)
+    if not decomposition.services_identifies:
+        return decomposition, {}
+    
+    candidats = await search_candidates_for_services(decomposition)
+    
+    _decomposition_cache[_decomposition_cache_key(user_request)] = (decomposition, candidats)
+    
+    return decomposition, candidats
+
+def _reformulation_context(
+    services_refuses: List[str],
     services_valides: List[str],
     historique: List[str]
 ) -> str:
-    """Phase 3 : Reformulation CIBLÉE sur services refusés uniquement."""
-    context = f"""
+    return f"""
 Services DÉJÀ VALIDÉS (à ne pas mentionner) : {', '.join(services_valides)}
 
 Services REFUSÉS (à clarifier) : {', '.join(services_refuses)}
@@ -399,9 +591,28 @@ Historique :
 Pose UNE question UNIQUEMENT sur les services refusés pour comprendre pourquoi 
 l'utilisateur les a rejetés et pouvoir proposer des alternatives.
 """
+
+async def reformulate_request(
+    services_refuses: List[str], 
+    services_valides: List[str],
+    historique: List[str]
+) -> str:
+    """Phase 3 : Reformulation CIBLÉE sur services refusés uniquement."""
+    context = _reformulation_context(services_refuses, services_valides, historique)
     result = await reformulation_agent.run(context)
     return result.data
 
+async def reformulate_request_stream(
+    services_refuses: List[str],
+    services_valides: List[str],
+    historique: List[str]
+) -> AsyncIterator[str]:
+    """Phase 3 en streaming : question renvoyée token par token."""
+    context = _reformulation_context(services_refuses, services_valides, historique)
+    async with reformulation_agent.run_stream(context) as result:
+        async for delta in result.stream_text(delta=True):
+            yield delta
+
 async def handle_clarification_with_merge(
     user_clarification: str,
     services_valides_noms: List[str],
@@ -434,9 +645,10 @@ NE REPROPOSE PAS les services déjà validés : {', '.join(services_valides_noms
     new_decomposition = await decompose_request(targeted_request)
     
     # Filtrer les doublons
+    valides_set = set(services_valides_noms)
     filtered_services = [
         service for service in new_decomposition.services_identifies
-        if service.nom not in services_valides_noms
+        if service.nom not in valides_set
     ]
     
     return Decomposition(services_identifies=filtered_services)
@@ -561,6 +773,7 @@ def generate_tmf921_intent(
 
 def build_constraint(prop_name: str, prop_value: Any) -> Dict[str, Any]:
     """Construit constraint ICM."""
+    value_of = f"cem:{prop_name}"
     
     if isinstance(prop_value, str):
         parsed = parse_value_with_unit(prop_value)
@@ -570,46 +783,50 @@ def build_constraint(prop_name: str, prop_value: Any) -> Dict[str, Any]:
             
             return {
                 f"icm:{operator}": {
-                    "icm:ValueOf": f"cem:{prop_name}",
+                    "icm:ValueOf": value_of,
                     "icm:value": value,
                     "cem:unit": unit
                 }
             }
     
-    if isinstance(prop_value, dict) and "min" in prop_value and "max" in prop_value:
-        return {
-            "icm:between": {
-                "icm:ValueOf": f"cem:{prop_name}",
-                "icm:min": prop_value["min"],
-                "icm:max": prop_value["max"],
-                "cem:unit": prop_value.get("unit", "")
+    elif isinstance(prop_value, dict):
+        has_min = "min" in prop_value
+        has_max = "max" in prop_value
+        
+        if has_min and has_max:
+            return {
+                "icm:between": {
+                    "icm:ValueOf": value_of,
+                    "icm:min": prop_value["min"],
+                    "icm:max": prop_value["max"],
+                    "cem:unit": prop_value.get("unit", "")
+                }
             }
-        }
-    
-    if isinstance(prop_value, dict) and ("min" in prop_value or "max" in prop_value):
-        operator = "greater" if "min" in prop_value else "smaller"
-        value_key = "min" if "min" in prop_value else "max"
         
-        return {
-            f"icm:{operator}": {
-                "icm:ValueOf": f"cem:{prop_name}",
-                "icm:value": prop_value[value_key],
-                "cem:unit": prop_value.get("unit", "")
+        if has_min or has_max:
+            operator = "greater" if has_min else "smaller"
+            value_key = "min" if has_min else "max"
+            
+            return {
+                f"icm:{operator}": {
+                    "icm:ValueOf": value_of,
+                    "icm:value": prop_value[value_key],
+                    "cem:unit": prop_value.get("unit", "")
+                }
             }
-        }
     
     return {
         "icm:equals": {
-            "icm:ValueOf": f"cem:{prop_name}",
+            "icm:ValueOf": value_of,
             "icm:value": prop_value
         }
     }
 
+_UNIT_RE = re.compile(r'^([0-9.]+)\s*([a-zA-Z%]+)$')
+
 def parse_value_with_unit(value_str: str) -> Optional[tuple]:
     """Parse '10ms', '100Mbps', etc."""
-    import re
-    
-    match = re.match(r'^([0-9.]+)\s*([a-zA-Z%]+)$', value_str.strip())
+    match = _UNIT_RE.match(value_str.strip())
     if match:
         num_str, unit = match.groups()
         try:
@@ -619,14 +836,15 @@ def parse_value_with_unit(value_str: str) -> Optional[tuple]:
             return None
     return None
 
+_SMALLER_RE = re.compile(r'latence|latency|delay|jitter', re.I)
+_GREATER_RE = re.compile(r'debit|bandwidth|throughput|disponibilite|availability', re.I)
+
 def infer_operator(prop_name: str) -> str:
     """Infère opérateur selon propriété."""
-    prop_lower = prop_name.lower()
-    
-    if any(k in prop_lower for k in ['latence', 'latency', 'delay', 'jitter']):
+    if _SMALLER_RE.search(prop_name):
         return 'smaller'
     
-    if any(k in prop_lower for k in ['debit', 'bandwidth', 'throughput', 'disponibilite', 'availability']):
+    if _GREATER_RE.search(prop_name):
         return 'greater'
     
     return 'equals'
@@ -1,30 +1,60 @@
 
 from fastapi import FastAPI, HTTPException, Body
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from typing import List, Dict, Optional, Any
 import asyncio
 import os
+import orjson
 from dotenv import load_dotenv
 
 # Import depuis agent.py
 from agent import (
     classify_and_route,
-    decompose_request,
+    classify_and_route_stream,
+    decompose_and_search,
     search_candidates_for_services,
     generate_tmf921_intent,
     reformulate_request,
+    reformulate_request_stream,
     handle_clarification_with_merge,
     recommend_alternatives,
     ConversationState,
+    embedder,
+    index,
     ServiceIdentified,
     Decomposition,
     ServiceCandidate,
+    ServiceDependency,
     TMF921Intent
 )
 
 load_dotenv()
 
+# ============================================================================
+# SÉRIALISATION JSON (orjson)
+# ============================================================================
+
+def orjson_default(obj: Any) -> Any:
+    """Types non gérés nativement par orjson (modèles pydantic)."""
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    raise TypeError(f"Type non sérialisable : {type(obj).__name__}")
+
+def json_fragment(model: BaseModel) -> orjson.Fragment:
+    """JSON pré-sérialisé par le sérialiseur Rust de pydantic (sans dict intermédiaire)."""
+    return orjson.Fragment(model.__pydantic_serializer__.to_json(model))
+
+class ORJSONResponse(JSONResponse):
+    """Réponse JSON sérialisée par orjson."""
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(
+            content,
+            default=orjson_default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        )
+
 # ============================================================================
 # FASTAPI APP
 # ============================================================================
@@ -32,7 +62,8 @@ load_dotenv()
 app = FastAPI(
     title="Agent Intent TMF921 API",
     description="API pour la génération automatique d'Intent TMF921 depuis langage naturel",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Configuration CORS 
@@ -44,6 +75,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def warmup():
+    """Préchauffe le modèle d'embedding et la connexion Pinecone."""
+    try:
+        await asyncio.to_thread(embedder.encode, "warmup")
+        await asyncio.to_thread(index.describe_index_stats)
+    except Exception as e:
+        print(f"⚠️  Préchauffage incomplet : {e}")
+
 # ============================================================================
 # MODELS D'ENTRÉE/SORTIE
 # ============================================================================
@@ -86,6 +126,11 @@ class ClarificationRequest(BaseModel):
         description="Services identifiés lors de la décomposition initiale"
     )
 
+class ReformulateRequest(BaseModel):
+    services_refuses: List[str]
+    services_valides: List[str]
+    historique: List[str]
+
 class AlternativesRequest(BaseModel):
     services_refuses: List[str]
     services_valides: List[str]
@@ -111,9 +156,11 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "classification": "/api/classify",
+            "classification_stream": "/api/classify/stream",
             "decomposition": "/api/decompose",
             "validation": "/api/validate",
             "clarification": "/api/clarify",
+            "reformulation_stream": "/api/reformulate/stream",
             "alternatives": "/api/alternatives",
             "intent_generation": "/api/generate-intent"
         }
@@ -133,7 +180,25 @@ async def classify(request: ClassifyRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/decompose", response_model=DecomposeResponse)
+async def sse_events(events):
+    """Convertit un flux d'événements en Server-Sent Events."""
+    try:
+        async for event in events:
+            yield b"data: " + orjson.dumps(event) + b"\n\n"
+    except Exception as e:
+        yield b"event: error\ndata: " + orjson.dumps({"detail": str(e)}) + b"\n\n"
+
+@app.post("/api/classify/stream")
+async def classify_stream(request: ClassifyRequest):
+    """
+    Classification en streaming (SSE) : le type puis le message token par token
+    """
+    return StreamingResponse(
+        sse_events(classify_and_route_stream(request.user_input)),
+        media_type="text/event-stream"
+    )
+
+@app.post("/api/decompose", responses={200: {"model": DecomposeResponse}})
 async def decompose(request: DecomposeRequest):
     """
     Décomposer la demande en services identifiés et rechercher les candidats.
@@ -143,8 +208,8 @@ async def decompose(request: DecomposeRequest):
     - candidates: Dictionnaire des candidats (avec dépendances complètes) pour chaque service
     """
     try:
-        # Décomposition
-        decomposition = await decompose_request(request.user_input)
+        # Décomposition + recherche des candidats (cache TTL)
+        decomposition, candidates = await decompose_and_search(request.user_input)
         
         if not decomposition.services_identifies:
             raise HTTPException(
@@ -152,22 +217,19 @@ async def decompose(request: DecomposeRequest):
                 detail="Aucun service identifié. Veuillez reformuler."
             )
         
-        # Recherche des candidats
-        candidates = await search_candidates_for_services(decomposition)
-        
         # Conversion en dict pour la réponse
-        services_dict = [s.model_dump() for s in decomposition.services_identifies]
+        services_dict = [json_fragment(s) for s in decomposition.services_identifies]
         
         
         candidates_dict = {
-            service_name: [c.model_dump() for c in candidats_list]
+            service_name: [json_fragment(c) for c in candidats_list]
             for service_name, candidats_list in candidates.items()
         }
         
-        return DecomposeResponse(
-            services_identifies=services_dict,
-            candidates=candidates_dict
-        )
+        return ORJSONResponse({
+            "services_identifies": services_dict,
+            "candidates": candidates_dict
+        })
     
     except HTTPException:
         raise
@@ -209,40 +271,59 @@ async def clarify(request: ClarificationRequest):
         
         # 3. FUSION : reconstruire la liste complète des services identifiés
         #    = services précédents validés + nouveaux services de la clarification
-        merged_services_identifies = []
-        merged_candidates = {}
+        valides_set = set(request.services_valides_noms)
+        valides_data = request.services_valides_data or {}
 
         # a) Réintégrer les services précédemment identifiés ET validés
-        if request.services_identifies_precedents:
-            for svc_data in request.services_identifies_precedents:
-                svc_nom = svc_data.get("nom", "")
-                # On ne garde que ceux qui avaient été validés
-                if svc_nom in request.services_valides_noms:
-                    merged_services_identifies.append(svc_data)
-                    # Réinjecter leurs candidats depuis les données validées
-                    if request.services_valides_data and svc_nom in request.services_valides_data:
-                        candidate_data = request.services_valides_data[svc_nom]
-                        merged_candidates[svc_nom] = [candidate_data]
-
-        # b) Ajouter les nouveaux services issus de la clarification
-        for new_svc in new_decomposition.services_identifies:
-            # Éviter les doublons avec les services déjà validés
-            if new_svc.nom not in request.services_valides_noms:
-                merged_services_identifies.append(new_svc.model_dump())
-                merged_candidates[new_svc.nom] = [
-                    c.model_dump() for c in new_candidates.get(new_svc.nom, [])
-                ]
+        previous_valides = [
+            svc_data for svc_data in (request.services_identifies_precedents or [])
+            if svc_data.get("nom", "") in valides_set
+        ]
+        # b) Nouveaux services issus de la clarification (hors doublons validés)
+        new_services = [
+            new_svc for new_svc in new_decomposition.services_identifies
+            if new_svc.nom not in valides_set
+        ]
 
-        return {
+        merged_services_identifies = previous_valides + [json_fragment(svc) for svc in new_services]
+        merged_candidates = {
+            # Réinjecter les candidats depuis les données validées
+            **{
+                svc_data["nom"]: [valides_data[svc_data["nom"]]]
+                for svc_data in previous_valides
+                if svc_data["nom"] in valides_data
+            },
+            **{
+                new_svc.nom: [json_fragment(c) for c in new_candidates.get(new_svc.nom, [])]
+                for new_svc in new_services
+            }
+        }
+
+        return ORJSONResponse({
             "services_identifies": merged_services_identifies,
             "candidates": merged_candidates,
             # Indicateur pour le frontend : quels services sont pré-validés
             "pre_validated_services": request.services_valides_noms
-        }
+        })
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/reformulate/stream")
+async def reformulate_stream(request: ReformulateRequest):
+    """
+    Question de clarification en streaming (SSE) sur les services refusés
+    """
+    async def deltas():
+        async for delta in reformulate_request_stream(
+            services_refuses=request.services_refuses,
+            services_valides=request.services_valides,
+            historique=request.historique
+        ):
+            yield {"message": delta}
+    
+    return StreamingResponse(sse_events(deltas()), media_type="text/event-stream")
+
 @app.post("/api/alternatives")
 async def get_alternatives(request: AlternativesRequest):
     """
@@ -262,7 +343,7 @@ async def get_alternatives(request: AlternativesRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/generate-intent", response_model=GenerateIntentResponse)
+@app.post("/api/generate-intent", responses={200: {"model": GenerateIntentResponse}})
 async def generate_intent(request: GenerateIntentRequest):
     """
     Générer l'Intent TMF921 final
@@ -272,22 +353,30 @@ async def generate_intent(request: GenerateIntentRequest):
         state = ConversationState()
         state.user_request_original = request.user_request_original
         
-        # Reconstruction des services validés
+        # Reconstruction des services validés (données issues de /api/decompose :
+        # pas de revalidation, model_construct ne construit pas les modèles imbriqués)
         for service_name, candidate_data in request.services_valides.items():
-            candidate = ServiceCandidate(**candidate_data)
+            candidate = ServiceCandidate.model_construct(**{
+                **candidate_data,
+                "dependencies": [
+                    ServiceDependency.model_construct(**dep)
+                    for dep in candidate_data.get("dependencies", [])
+                ]
+            })
             state.services_valides[service_name] = candidate
         
         # Reconstruction des services identifiés
-        for service_data in request.services_identifies:
-            service = ServiceIdentified(**service_data)
-            state.add_identified_services([service])
+        state.add_identified_services([
+            ServiceIdentified.model_construct(**service_data)
+            for service_data in request.services_identifies
+        ])
         
-        # Génération de l'intent
-        intent = generate_tmf921_intent(state)
+        # Génération de l'intent (hors de la boucle d'événements)
+        intent = await asyncio.to_thread(generate_tmf921_intent, state)
         
-        return GenerateIntentResponse(
-            intent=intent.model_dump()
-        )
+        return ORJSONResponse({
+            "intent": json_fragment(intent)
+        })
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -307,5 +396,12 @@ async def health_check():
 # ============================================================================
 
 if __name__ == "__main__":
+    # Lancement direct (un seul processus) ; pour plusieurs workers : python serve.py
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(os.getenv("BACKEND_PORT", "8000")),
+        loop="uvloop",
+        http="httptools"
+    )
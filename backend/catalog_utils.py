@@ -0,0 +1,22 @@
+# catalog_utils.py
+# Lecture des spécifications TMF633, partagée par agent.py et ingest_catalog.py.
+from typing import Dict, List
+
+
+def extract_dependency_specs(service_json: Dict) -> List[Dict[str, str]]:
+    """Extrait dépendances CFSS uniquement (dicts name/id/version/href)."""
+    dependencies = []
+
+    for rel in service_json.get('serviceSpecRelationship', []):
+        if rel.get('relationshipType') == 'dependsOn':
+            spec = rel.get('serviceSpec', {})
+
+            if spec.get('@referredType') == 'CustomerFacingServiceSpecification':
+                dependencies.append({
+                    "name": spec.get('name', 'Unknown'),
+                    "id": spec.get('id', 'unknown'),
+                    "version": spec.get('version', '1.0.0'),
+                    "href": spec.get('href', '')
+                })
+
+    return dependencies
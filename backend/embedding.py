@@ -0,0 +1,60 @@
+# embedding.py
+# Chargement du modèle d'embedding, partagé par agent.py (requêtes) et
+# ingest_catalog.py (catalogue) : les vecteurs doivent venir du même modèle.
+import os
+from dotenv import load_dotenv
+from sentence_transformers import SentenceTransformer
+import torch
+
+load_dotenv()
+
+# Modèle d'embedding : ONNX quantifié int8 sur CPU, repli OpenVINO puis PyTorch
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+ONNX_INT8_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+# Nombre de workers uvicorn partageant la machine (voir api.py)
+API_WORKERS = max(1, int(os.getenv("API_WORKERS", "1")))
+
+# Threads d'inférence CPU par processus (défaut : moitié des cœurs,
+# répartie entre les workers pour ne pas sursouscrire le CPU)
+EMBEDDING_NUM_THREADS = int(os.getenv(
+    "TORCH_NUM_THREADS",
+    max(1, (os.cpu_count() or 2) // 2 // API_WORKERS)
+))
+
+
+def load_embedder() -> SentenceTransformer:
+    """Charge le modèle d'embedding (ONNX int8 si disponible)."""
+    # PyTorch en mode inférence uniquement
+    torch.set_num_threads(EMBEDDING_NUM_THREADS)
+    torch.set_grad_enabled(False)
+
+    if EMBEDDING_BACKEND == "onnx":
+        try:
+            import onnxruntime
+            session_options = onnxruntime.SessionOptions()
+            session_options.intra_op_num_threads = EMBEDDING_NUM_THREADS
+            return SentenceTransformer(
+                EMBEDDING_MODEL,
+                backend="onnx",
+                model_kwargs={"file_name": ONNX_INT8_FILE, "session_options": session_options}
+            )
+        except Exception as e:
+            print(f"⚠️  Backend ONNX indisponible ({e}), essai OpenVINO")
+        try:
+            return SentenceTransformer(
+                EMBEDDING_MODEL,
+                backend="openvino",
+                model_kwargs={"ov_config": {"INFERENCE_NUM_THREADS": str(EMBEDDING_NUM_THREADS)}}
+            )
+        except Exception as e:
+            print(f"⚠️  Backend OpenVINO indisponible ({e}), utilisation de PyTorch")
+    model = SentenceTransformer(EMBEDDING_MODEL)
+
+    # Option : noyaux fusionnés via torch.compile (backend torch uniquement)
+    transformer = model._first_module()
+    if os.getenv("TORCH_COMPILE") == "1" and hasattr(transformer, "auto_model"):
+        transformer.auto_model = torch.compile(transformer.auto_model, dynamic=True)
+
+    return model
@@ -1,25 +1,34 @@
 # ingest_catalog.py
 import os
 import json
+import orjson
 import re
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer
+from embedding import load_embedder
+from catalog_utils import extract_dependency_specs
 from pinecone import Pinecone, ServerlessSpec
+from pinecone.exceptions import PineconeApiException
 import sys
+import time
 import unicodedata
 
 load_dotenv()
 
-# Modèle d'embedding local 
-embedder = SentenceTransformer('all-MiniLM-L6-v2')
+# Modèle d'embedding local (module partagé avec agent.py)
+embedder = load_embedder()
 
 # Initialisation du client Pinecone
 pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
 
 index_name = os.getenv("PINECONE_INDEX_NAME", "telecom-catalog11")
 
+# Nombre de batches d'upsert envoyés simultanément
+UPSERT_CONCURRENCY = 10
+
 # Path absolu 
 CATALOG_DIR = Path(__file__).parent / "catalog1"
 
@@ -40,6 +49,15 @@ print(f"✅ Dossier catalog trouvé : {CATALOG_DIR.absolute()}")
 print(f"📁 {len(json_files)} fichier(s) JSON détecté(s)")
 
 
+# Tables / patterns précompilés pour sanitize_id
+_COMBINING = dict.fromkeys(
+    c for c in range(sys.maxunicode + 1) if unicodedata.combining(chr(c))
+)
+_DASHES = str.maketrans({'–': '-', '—': '-', '−': '-'})
+_DISALLOWED_RE = re.compile(r'[^\w\s-]')
+_SEPARATORS_RE = re.compile(r'[\s_]+')
+
+
 def sanitize_id(text: str) -> str:
     """
     Normaliser les IDs pour Pinecone (ASCII uniquement)
@@ -55,18 +73,17 @@ def sanitize_id(text: str) -> str:
     text = unicodedata.normalize('NFKD', text)
     
     # Suppression des accents (catégorie Mn = Mark, Nonspacing)
-    text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = text.translate(_COMBINING)
     
     # Remplacement des tirets spéciaux (–, —) par tiret normal
-    text = text.replace('–', '-').replace('—', '-').replace('−', '-')
+    text = text.translate(_DASHES)
     
     # Suppression de tous les caractères non-ASCII
     text = text.encode('ascii', 'ignore').decode('ascii')
     
     # Nettoyage final
-    text = re.sub(r'[^\w\s-]', '', text)  # Garder uniquement lettres, chiffres, -, _
-    text = re.sub(r'\s+', '_', text)       # Espaces → underscores
-    text = re.sub(r'_+', '_', text)        # Multiples underscores → 1 seul
+    text = _DISALLOWED_RE.sub('', text)    # Garder uniquement lettres, chiffres, -, _
+    text = _SEPARATORS_RE.sub('_', text)   # Espaces / underscores multiples → 1 seul _
     text = text.strip('_-').lower()        # Supprime _ ou - en début/fin
     
     return text or "unknown_service"
@@ -103,20 +120,24 @@ def generate_summary(service_json: dict) -> str:
     char_lines = []
 
     for char in service_json.get("serviceSpecCharacteristic", []):
-        char_name        = char.get("name", "").strip()
-        char_desc        = (char.get("description") or "").strip()
-        value_type       = char.get("valueType", "").upper()
-        configurable     = char.get("configurable", False)
+        get              = char.get
+        char_name        = get("name", "").strip()
+        char_desc        = (get("description") or "").strip()
+        value_type       = get("valueType", "").upper()
+        configurable     = get("configurable", False)
+        values           = get("serviceSpecCharacteristicValue", [])
 
         # On saute les caractéristiques vides ou très techniques sans valeur métier
-        if not char_name or not any(v.get("value") for v in char.get("serviceSpecCharacteristicValue", [])):
+        if not char_name or not any(v.get("value") for v in values):
             continue
 
-        # Préparation du texte de la valeur(s)
-        value_strs = []
+        # Préparation du texte de la valeur(s) : dict = ensemble ordonné
+        # (nettoyage + déduplication en une seule passe)
+        seen = {}
 
-        for val_item in char.get("serviceSpecCharacteristicValue", []):
-            v = val_item.get("value", {}) if isinstance(val_item.get("value"), dict) else {}
+        for val_item in values:
+            item_value = val_item.get("value")
+            v = item_value if isinstance(item_value, dict) else {}
             alias = v.get("alias", "").strip()
             raw_value = v.get("value", "")
 
@@ -124,37 +145,36 @@ def generate_summary(service_json: dict) -> str:
             if alias:
                 disp_value = alias
                 if raw_value and str(raw_value) != alias:
-                    disp_value += f" ({raw_value})"
+                    disp_value = "".join((alias, " (", str(raw_value), ")"))
             else:
                 disp_value = str(raw_value) if raw_value else ""
 
             # Cas 2 : plage de valeurs
             if "valueFrom" in val_item and "valueTo" in val_item:
-                from_v = val_item.get("valueFrom")
-                to_v   = val_item.get("valueTo")
+                from_v = val_item["valueFrom"]
+                to_v   = val_item["valueTo"]
                 if from_v is not None and to_v is not None:
                     disp_value = f"{from_v} – {to_v}"
 
-            value_strs.append(disp_value)
-
-        # Nettoyage & déduplication
-        value_strs = [s.strip() for s in value_strs if s.strip()]
-        value_strs = list(dict.fromkeys(value_strs))   # ordre préservé, pas de doublons
+            disp_value = disp_value.strip()
+            if disp_value and disp_value not in seen:
+                seen[disp_value] = None
 
-        if not value_strs:
+        if not seen:
             continue
 
-        # Format final de la caractéristique
-        values_joined = " | ".join(value_strs)
-
         # On préfère la description courte si elle existe, sinon le nom
         label = char_desc or char_name
 
         # Ajout d'un indicateur configurable quand c'est pertinent
         prefix = "configurable • " if configurable else ""
 
-        line = f"{prefix}{label} : {values_joined}"
-        char_lines.append(line)
+        # Format final de la caractéristique (une seule concaténation)
+        char_lines.append("".join((prefix, label, " : ", " | ".join(seen))))
+
+        # Seules les 25 premières lignes sont retenues
+        if len(char_lines) == 25:
+            break
 
     # Ajout du bloc caractéristiques
     if char_lines:
@@ -174,6 +194,42 @@ def generate_summary(service_json: dict) -> str:
     return text.lower()
 
 
+def load_json_file(json_file: Path) -> tuple:
+    """
+    Lecture d'un fichier JSON (exécutée dans un thread)
+    Retourne (fichier, service) ou (fichier, exception)
+    """
+    try:
+        # orjson.JSONDecodeError hérite de json.JSONDecodeError
+        return json_file, orjson.loads(json_file.read_bytes())
+    except Exception as e:
+        return json_file, e
+
+
+def upsert_with_retry(index, batch: list, attempts: int = 3):
+    """
+    Nouvel essai synchrone d'un batch échoué (backoff exponentiel)
+    """
+    for attempt in range(attempts):
+        time.sleep(2 ** attempt)
+        try:
+            index.upsert(vectors=batch)
+            return
+        except PineconeApiException:
+            if attempt == attempts - 1:
+                raise
+
+
+def wait_upsert(index, batch: list, async_result):
+    """
+    Attend la fin d'un upsert asynchrone (nouvel essai si erreur API)
+    """
+    try:
+        async_result.get()
+    except PineconeApiException:
+        upsert_with_retry(index, batch)
+
+
 def create_index_if_not_exists():
     """Création de l'index Pinecone avec gestion d'erreurs"""
     try:
@@ -183,7 +239,7 @@ def create_index_if_not_exists():
             print(f"🔨 Création de l'index '{index_name}' (Serverless AWS)...")
             pc.create_index(
                 name=index_name,
-                dimension=384,  # Dimension du modèle all-MiniLM-L6-v2
+                dimension=embedder.get_sentence_embedding_dimension(),
                 metric="cosine",
                 spec=ServerlessSpec(
                     cloud="aws",
@@ -208,25 +264,36 @@ def ingest():
     
     # Connexion à l'index
     try:
-        index = pc.Index(index_name)
+        index = pc.Index(index_name, pool_threads=UPSERT_CONCURRENCY)
         print(f"✅ Connecté à l'index '{index_name}'")
     except Exception as e:
         print(f"❌ Erreur de connexion à l'index : {e}")
         sys.exit(1)
     
-    vectors_to_upsert = []
+    parsed_services = []
     skipped_files = []
     services_without_description = []
     
     print(f"\n🔄 Traitement des fichiers JSON...")
     
-    for json_file in tqdm(json_files, desc="Parsing JSON"):
+    # Lecture + parsing des fichiers en parallèle (I/O)
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        loaded_files = list(tqdm(
+            executor.map(load_json_file, json_files),
+            total=len(json_files),
+            desc="Parsing JSON"
+        ))
+    
+    for json_file, service in loaded_files:
         try:
-            with open(json_file, "r", encoding="utf-8") as f:
-                service = json.load(f)
+            # Erreur de lecture/parsing remontée par le thread
+            if isinstance(service, Exception):
+                raise service
+            
+            name = service.get("name", "")
             
             # Sanitize l'ID avant de l'utiliser
-            raw_id = service.get("id") or service.get("name", "")
+            raw_id = service.get("id") or name
             service_id = sanitize_id(raw_id)
             
             if not service_id or service_id == "unknown_service":
@@ -242,18 +309,18 @@ def ingest():
             # Génération du résumé optimisé (basé sur description)
             summary = generate_summary(service)
             
-            # Génération de l'embedding
-            embedding = embedder.encode(summary).tolist()
-            
             # Préparation des métadonnées (limitées à 40KB par vecteur)
+            # (troncature sans copie si le texte est déjà plus court)
             metadata = {
                 "service_id": service_id,
-                "name": service.get("name", "")[:500],
+                "name": name[:500],
                 "description": description[:2000],  # ✅ Description complète stockée
-                "summary": summary[:2000]  # Pour debug si nécessaire
+                "summary": summary[:2000],  # Pour debug si nécessaire
+                # Pinecone n'accepte pas de liste d'objets → JSON sérialisé
+                "dependencies": orjson.dumps(extract_dependency_specs(service)).decode("utf-8")
             }
             
-            vectors_to_upsert.append((service_id, embedding, metadata))
+            parsed_services.append((service_id, summary, metadata))
         
         except json.JSONDecodeError as e:
             print(f"⚠️  Fichier JSON invalide : {json_file.name} ({e})")
@@ -262,28 +329,55 @@ def ingest():
             print(f"⚠️  Erreur lors du traitement de {json_file.name} : {e}")
             skipped_files.append(json_file.name)
     
-    if not vectors_to_upsert:
+    if not parsed_services:
         print("❌ Aucun service valide à indexer")
         sys.exit(1)
     
-    # Upsert par batch avec gestion d'erreurs
-    print(f"\n📤 Indexation de {len(vectors_to_upsert)} services dans Pinecone...")
+    # Pipeline embedding → upsert : chaque batch est envoyé (async) dès qu'il
+    # est encodé, pendant que le batch suivant est calculé
+    print(f"\n📤 Embedding + indexation de {len(parsed_services)} services dans Pinecone...")
     
     batch_size = 100
     success_count = 0
     failed_batches = []
+    in_flight = deque()  # au plus UPSERT_CONCURRENCY batches en mémoire/en vol
     
-    for i in tqdm(range(0, len(vectors_to_upsert), batch_size), desc="Upsert batches"):
-        batch = vectors_to_upsert[i:i + batch_size]
+    def finish_upsert(batch_num: int, batch: list, async_result) -> int:
         try:
-            index.upsert(vectors=batch)
-            success_count += len(batch)
+            wait_upsert(index, batch, async_result)
+            return len(batch)
         except Exception as e:
-            print(f"⚠️  Erreur lors de l'upsert du batch {i//batch_size + 1} : {e}")
-            failed_batches.append(i//batch_size + 1)
+            print(f"⚠️  Erreur lors de l'upsert du batch {batch_num} : {e}")
+            failed_batches.append(batch_num)
             
             # Affichage des IDs problématiques pour debug
             print(f"   IDs du batch échoué : {[v[0] for v in batch[:3]]}...")
+            return 0
+    
+    num_batches = (len(parsed_services) + batch_size - 1) // batch_size
+    with tqdm(total=num_batches, desc="Embedding + upsert") as progress:
+        for batch_num, start in enumerate(range(0, len(parsed_services), batch_size), 1):
+            chunk = parsed_services[start:start + batch_size]
+            embeddings = embedder.encode(
+                [summary for _, summary, _ in chunk],
+                batch_size=64,
+                convert_to_numpy=True,
+                normalize_embeddings=True,  # cohérent avec les requêtes (agent.py)
+                show_progress_bar=False
+            ).tolist()
+            batch = [
+                (service_id, embedding, metadata)
+                for (service_id, _, metadata), embedding in zip(chunk, embeddings)
+            ]
+            in_flight.append((batch_num, batch, index.upsert(vectors=batch, async_req=True)))
+            
+            if len(in_flight) >= UPSERT_CONCURRENCY:
+                success_count += finish_upsert(*in_flight.popleft())
+                progress.update(1)
+        
+        while in_flight:
+            success_count += finish_upsert(*in_flight.popleft())
+            progress.update(1)
     
     # Statistiques finales
     print(f"\n{'='*60}")
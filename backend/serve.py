@@ -0,0 +1,27 @@
+# serve.py
+# Lanceur uvicorn : n'importe NI agent NI embedding, pour que le processus
+# superviseur ne charge ni modèle ni catalogue ni client Pinecone
+# (seuls les workers importent api.py).
+import os
+import uvicorn
+from dotenv import load_dotenv
+
+load_dotenv()
+
+if __name__ == "__main__":
+    # Un seul worker par défaut : la décomposition spéculative et les caches
+    # (classification, décomposition, embeddings) vivent en mémoire du processus.
+    # API_WORKERS > 1 : chaque worker charge ses propres modèles / clients Pinecone,
+    # la décomposition spéculative est désactivée et les threads d'inférence
+    # sont répartis entre workers (voir embedding.py).
+    workers = max(1, int(os.getenv("API_WORKERS", "1")))
+    # Propagé aux workers : embedding.py lit le nombre réellement lancé
+    os.environ["API_WORKERS"] = str(workers)
+    uvicorn.run(
+        "api:app",
+        host="0.0.0.0",
+        port=int(os.getenv("BACKEND_PORT", "8000")),
+        workers=workers,
+        loop="uvloop",
+        http="httptools"
+    )